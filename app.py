@@ -1,18 +1,49 @@
+# Monkey-patch the standard library for gevent BEFORE anything imports
+# sockets/ssl (requests, grpc, etc.), so the gevent gunicorn workers can
+# overlap the webhook's network waits. Harmless no-op when gevent is absent.
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:
+    pass
+else:
+    # gevent cannot yield around blocking calls inside grpc's C core, so
+    # without this hook every STT call would stall the whole worker's event
+    # loop. init_gevent() routes grpc's work through the gevent loop.
+    try:
+        import grpc.experimental.gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+    except ImportError:
+        pass
+
 import os
 import re
 import io
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import time
+import queue
+import sqlite3
+import hashlib
+import functools
+import threading
+import concurrent.futures
+import cachetools
+from datetime import date, datetime, timedelta
+from typing import Optional, Dict, Any, Protocol
 import traceback # NEW: Import traceback for detailed error logging
 
 from flask import Flask, request, Response
+from werkzeug.middleware.proxy_fix import ProxyFix
 from twilio.rest import Client
+from twilio.request_validator import RequestValidator
 from twilio.twiml.messaging_response import MessagingResponse
 
 # Google Cloud Imports
+import grpc
 from google.cloud import speech
+from google.oauth2 import service_account
 import gspread
 from gspread import Worksheet
 
@@ -20,6 +51,12 @@ from gspread import Worksheet
 
 app = Flask(__name__)
 
+# Render terminates TLS at its proxy, so without this request.url is
+# reconstructed as http://... while Twilio signs the public https URL —
+# signature validation would then 403 every legitimate webhook. Trust one
+# hop of X-Forwarded-Proto/Host/For from the platform proxy.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
 # CONFIGURATION VARIABLES
 TWILIO_ACCOUNT_SID = os.environ.get("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
@@ -36,18 +73,95 @@ except Exception as e:
     print(f"WARNING: Twilio Client initialization failed: {e}")
     client = None
 
-# **STATE MANAGEMENT**: A simple, temporary in-memory store for pending transcriptions.
-PENDING_TRANSCRIPTIONS: Dict[str, str] = {} 
+# Validates X-Twilio-Signature (constant-time HMAC-SHA1) so forged webhooks
+# are rejected in microseconds, before any media download or STT spend.
+# Left as None when the auth token is missing so local testing still works.
+_REQUEST_VALIDATOR = RequestValidator(TWILIO_AUTH_TOKEN) if TWILIO_AUTH_TOKEN else None
+
+# **STATE MANAGEMENT**: Pending transcriptions live in Redis (with a TTL) when
+# REDIS_URL is configured, so the two-step flow survives restarts and works
+# across multiple gunicorn workers. Without Redis we fall back to an
+# in-process store, which only supports a single worker.
+_PENDING_TTL_SECONDS = 600
+
+# TTL + size bound so abandoned voice notes (users who never reply '1')
+# cannot grow worker memory without limit. Dict-compatible with the old
+# plain dict, and matches the Redis TTL above.
+PENDING_TRANSCRIPTIONS: cachetools.TTLCache = cachetools.TTLCache(
+    maxsize=10_000, ttl=_PENDING_TTL_SECONDS
+)
+
+try:
+    import redis
+    _REDIS_URL = os.environ.get("REDIS_URL")
+    _REDIS = redis.Redis.from_url(_REDIS_URL, decode_responses=True) if _REDIS_URL else None
+except ImportError:
+    print("WARNING: redis not installed. Using in-process pending store (single worker only).")
+    _REDIS = None
+except Exception as e:
+    print(f"WARNING: Redis connection setup failed: {e}")
+    _REDIS = None
+
+def _store_pending_transcription(number: str, text: str) -> None:
+    """Saves a transcription awaiting the user's '1' confirmation."""
+    if _REDIS is not None:
+        try:
+            _REDIS.setex(f"pend:{number}", _PENDING_TTL_SECONDS, text)
+            return
+        except Exception as e:
+            print(f"WARNING: Redis write failed, falling back to in-process store: {e}")
+    PENDING_TRANSCRIPTIONS[number] = text
+
+def _pop_pending_transcription(number: str) -> Optional[str]:
+    """Removes and returns the pending transcription, or None if there is none."""
+    if _REDIS is not None:
+        try:
+            return _REDIS.getdel(f"pend:{number}")
+        except Exception as e:
+            print(f"WARNING: Redis read failed, falling back to in-process store: {e}")
+    return PENDING_TRANSCRIPTIONS.pop(number, None)
+
+# Shared HTTP session so every media download reuses the pooled keep-alive
+# connection to api.twilio.com instead of paying a new TLS handshake per webhook.
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Shared pool for overlapping network-bound work (media download, STT warm-up)
+# instead of running the webhook steps strictly one after another.
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8)
 
 # --- Google Sheets and STT Setup ---
 
+# One service-account credential shared by Sheets and STT, so the JSON key is
+# read and the OAuth token exchange performed once per worker instead of once
+# per client, and both clients share the same token-refresh state.
+_GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/cloud-platform",
+]
+
+try:
+    _GOOGLE_CREDS = service_account.Credentials.from_service_account_file(
+        GOOGLE_CREDENTIALS_PATH, scopes=_GOOGLE_SCOPES
+    )
+except Exception as e:
+    print(f"WARNING: Could not load Google service account credentials: {e}")
+    _GOOGLE_CREDS = None
+
 def setup_google_sheets() -> Worksheet:
     """Authenticates and returns the target Google Sheet worksheet."""
+    # Fail fast with the real cause instead of a confusing error deep
+    # inside gspread when the key file did not load.
+    if _GOOGLE_CREDS is None:
+        raise RuntimeError(
+            f"Google service account credentials failed to load from {GOOGLE_CREDENTIALS_PATH}; cannot authorize Sheets."
+        )
     try:
-        # gspread.service_account(filename=...) is correct for file path authentication
-        gc = gspread.service_account(filename=GOOGLE_CREDENTIALS_PATH)
-        sh = gc.open_by_key(GOOGLE_SHEET_ID) 
-        worksheet = sh.worksheet(WORKSHEET_NAME) 
+        # Authorize with the shared credential loaded above.
+        gc = gspread.authorize(_GOOGLE_CREDS)
+        sh = gc.open_by_key(GOOGLE_SHEET_ID)
+        worksheet = sh.worksheet(WORKSHEET_NAME)
         return worksheet
     except Exception as e:
         print(f"Error setting up Google Sheets. Make sure the Service Account is shared with the sheet: {e}")
@@ -69,10 +183,17 @@ except Exception:
 
 def setup_google_stt_client() -> speech.SpeechClient:
     """Authenticates and returns the Google Speech Client."""
+    # Without this guard SpeechClient(credentials=None) silently falls back
+    # to Application Default Credentials, which can pick up the wrong
+    # identity on GCP-adjacent hosts.
+    if _GOOGLE_CREDS is None:
+        raise RuntimeError(
+            f"Google service account credentials failed to load from {GOOGLE_CREDENTIALS_PATH}; refusing ADC fallback for STT."
+        )
     try:
-        import google.cloud.speech 
-        # Explicitly authenticate using the JSON file path
-        stt_client = speech.SpeechClient.from_service_account_json(GOOGLE_CREDENTIALS_PATH)
+        import google.cloud.speech
+        # Reuse the shared service-account credential loaded at startup
+        stt_client = speech.SpeechClient(credentials=_GOOGLE_CREDS)
         return stt_client
     except ImportError:
         print("WARNING: google-cloud-speech not installed. STT will fail.")
@@ -92,101 +213,344 @@ except Exception:
     print("FATAL: Google STT Client initialization failed during startup. Check credentials file path.")
     STT_CLIENT = None
 
+def _warm_stt_channel() -> None:
+    """Blocks until the gRPC channel to Google STT is actually connected, so
+    DNS, TCP, and TLS setup happen at startup instead of inside the first
+    recognize call. Failures are non-fatal."""
+    try:
+        grpc.channel_ready_future(STT_CLIENT.transport.grpc_channel).result(timeout=5)
+    except Exception as e:
+        print(f"STT channel warm-up failed (non-fatal): {e}")
+
+def _warm_twilio_session() -> None:
+    """Primes DNS + TLS to api.twilio.com so the first media download starts
+    on an already-open pooled connection."""
+    try:
+        _HTTP.get("https://api.twilio.com/", timeout=5)
+    except Exception as e:
+        print(f"Twilio session warm-up failed (non-fatal): {e}")
+
+# Pay the first-call connection setup at worker startup, off the import
+# thread, instead of on the first user's webhook.
+if STT_CLIENT is not None:
+    _EXECUTOR.submit(_warm_stt_channel)
+_EXECUTOR.submit(_warm_twilio_session)
+
 
 # --- Vaccination and Parsing Logic ---
 
-def calculate_reminders(delivery_date: datetime) -> str:
-    """Calculates vaccination reminder dates."""
-    guboro_date = delivery_date + timedelta(days=14)
-    lasota_date = delivery_date + timedelta(days=21)
-    
+@functools.lru_cache(maxsize=32)
+def _reminders_for_day(delivery_day: date) -> str:
+    """Formats the reminder string for one delivery day. Cached because every
+    confirmation on the same day produces the same string, and isoformat()
+    takes the C fast path that strftime's locale machinery does not."""
+    guboro_date = delivery_day + timedelta(days=14)
+    lasota_date = delivery_day + timedelta(days=21)
+
     return (
-        f"Guboro: {guboro_date.strftime('%Y-%m-%d')}; "
-        f"La Sota: {lasota_date.strftime('%Y-%m-%d')}"
+        f"Guboro: {guboro_date.isoformat()}; "
+        f"La Sota: {lasota_date.isoformat()}"
     )
 
+def calculate_reminders(delivery_date: datetime) -> str:
+    """Calculates vaccination reminder dates."""
+    return _reminders_for_day(delivery_date.date())
+
+# PERF: Compiled once at import instead of on every parse call, so each
+# "1"-confirmation request skips the regex compilation cost entirely.
+# One small pattern per field instead of a single chained ".*" pattern:
+# each search is a linear scan, so long transcripts no longer trigger
+# quadratic backtracking in the regex engine. The vocabulary is all ASCII,
+# so the patterns run against the once-lowercased transcription with
+# re.ASCII instead of paying Unicode case-folding via re.IGNORECASE.
+_CLIENT_RE = re.compile(r"client\s+(?P<client_index>[1-7])", re.ASCII)
+_DELIVERED_RE = re.compile(r"delivered\s+(?P<quantity>\d+)", re.ASCII)
+_PRICE_RE = re.compile(r"price\s+(?P<price>\d+)", re.ASCII)
+_NOTES_RE = re.compile(r"notes\s+(?P<notes>.*)", re.DOTALL | re.ASCII)
+
+# Keyword vocabularies scanned as plain literals instead of regex
+# alternations, so new feed types or locations can be added here without
+# growing any pattern. Scans run against the lowercased transcription.
+_FEED_TYPES = ("crumbs", "pellets", "day old chicks", "layer mash")
+_LOCATIONS = ("matangi", "kitengela", "mihang'o")
+
+def _first_keyword_hit(text: str, keywords: tuple) -> Optional[str]:
+    """Returns the keyword whose earliest occurrence in text comes first, or None."""
+    best_pos = -1
+    best_kw = None
+    for kw in keywords:
+        pos = text.find(kw)
+        if pos != -1 and (best_pos == -1 or pos < best_pos):
+            best_pos = pos
+            best_kw = kw
+    return best_kw
+
 def parse_delivery_transcription(transcription: str) -> Optional[Dict[str, Any]]:
     """
     Parses key fields from the transcribed text.
-    Uses regex to extract required fields, prioritizing numbers.
+    Runs one independent linear regex scan per field and returns None if
+    any required field (everything except notes) is missing.
     """
-    
-    pattern = re.compile(
-        # Client Index (1-7)
-        r".*client\s+(?P<client_index>[1-7])"                     
-        # Quantity and Feed Type (must capture the feed item)
-        r".*delivered\s+(?P<quantity>\d+)\s+(?P<feed_type>crumbs|pellets|day old chicks|layer mash)(?:\s+at)?"
-        r".*price\s+(?P<price>\d+)"                                     
-        # Location (constrained to your list)
-        r"(?:.*location\s+(?P<location>matangi|kitengela|mihang'o)\s*)"    
-        r"(?:.*notes\s+(?P<notes>.*))?",                              # Notes (captures the rest)
-        re.IGNORECASE | re.DOTALL
-    )
-    
-    match = pattern.search(transcription)
-    
-    if match:
-        data = match.groupdict()
-        # Clean up and normalize data
-        data['debt'] = int(data.get('debt', 0) or 0)
-        data['overpaid'] = int(data.get('overpaid', 0) or 0)
-        
+
+    lowered = transcription.lower()
+
+    client_match = _CLIENT_RE.search(lowered)
+    delivered_match = _DELIVERED_RE.search(lowered)
+    price_match = _PRICE_RE.search(lowered)
+    feed_type = _first_keyword_hit(lowered, _FEED_TYPES)
+    location = _first_keyword_hit(lowered, _LOCATIONS)
+
+    if not (client_match and delivered_match and price_match and feed_type and location):
+        return None
+
+    notes_match = _NOTES_RE.search(lowered)
+
+    try:
+        quantity = int(delivered_match.group('quantity'))
+        price = int(price_match.group('price'))
+    except ValueError:
+        return None
+
+    if notes_match:
+        # Slice the span out of the original text so notes keep their casing.
+        notes = transcription[notes_match.start('notes'):notes_match.end('notes')].strip()
+    else:
+        notes = 'N/A'
+
+    # The patterns guarantee the group shapes (single digit, digit runs), so
+    # no per-field strip/default dance is needed here.
+    return {
+        'client_index': client_match.group('client_index'),
+        'quantity': quantity,
+        'feed_type': feed_type,
+        'price': price,
+        'location': location,
+        'notes': notes,
+        'debt': 0,
+        'overpaid': 0,
+    }
+
+# Custom Vocabulary using your specific terms. The config/context protos are
+# immutable for the life of the service, so they are built once at import
+# instead of being reallocated on every transcription request.
+_PHRASE_HINTS = [
+    "crumbs", "pellets", "day old chicks", "layer mash",
+    "debt", "overpaid", "client", "price", "location",
+    "matangi", "kitengela", "mihang'o",
+    "one", "two", "three", "four", "five", "six", "seven",
+    "500", "1000", "2000", "1200", "delivered"
+]
+
+_SPEECH_CTX = speech.SpeechContext(phrases=_PHRASE_HINTS)
+
+_STT_CONFIG = speech.RecognitionConfig(
+    encoding=speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
+    sample_rate_hertz=16000,
+    language_code="en-US",
+    # FIX: Changed 'speech_context' to the correct plural form 'speech_contexts'
+    speech_contexts=[_SPEECH_CTX]
+)
+
+_STREAMING_CONFIG = speech.StreamingRecognitionConfig(
+    config=_STT_CONFIG,
+    single_utterance=True
+)
+
+_STT_CHUNK_SIZE = 16384
+
+# Cache of audio-hash -> transcription. Twilio retries webhooks on timeout and
+# users resend the same clip, so a hit here skips an entire STT round-trip.
+_STT_CACHE: cachetools.LRUCache = cachetools.LRUCache(maxsize=512)
+_STT_CACHE_LOCK = threading.Lock()
+
+def _audio_chunks(audio_bytes: bytes):
+    """Yields the audio as StreamingRecognizeRequest frames for streaming STT."""
+    for start in range(0, len(audio_bytes), _STT_CHUNK_SIZE):
+        yield speech.StreamingRecognizeRequest(
+            audio_content=audio_bytes[start:start + _STT_CHUNK_SIZE]
+        )
+
+class Transcriber(Protocol):
+    """Interface for pluggable speech-to-text backends."""
+
+    def transcribe(self, audio_bytes: bytes) -> str:
+        ...
+
+class GoogleSTTTranscriber:
+    """Default backend: Google Cloud streaming STT.
+
+    Uses the streaming API so recognition starts while the upload is still
+    in flight, instead of waiting for the whole clip with sync recognize.
+    """
+
+    def transcribe(self, audio_bytes: bytes) -> str:
+        if not STT_CLIENT:
+            return "STT_CLIENT is unavailable."
+
         try:
-            data['quantity'] = int(data.get('quantity'))
-            data['price'] = int(data.get('price')) 
-        except (ValueError, TypeError):
-             return None 
-
-        data['client_index'] = data.get('client_index', 'N/A').strip()
-        data['feed_type'] = data.get('feed_type', 'N/A').strip() 
-        data['location'] = data.get('location', 'N/A').strip()
-        data['notes'] = data.get('notes', 'N/A').strip()
-        
-        return data
-    return None
+            responses = STT_CLIENT.streaming_recognize(
+                config=_STREAMING_CONFIG,
+                requests=_audio_chunks(audio_bytes)
+            )
+            for response in responses:
+                for result in response.results:
+                    if result.is_final and result.alternatives:
+                        return result.alternatives[0].transcript
+            return ""
+        except Exception as e:
+            print(f"ERROR during Google STT recognition: {e}")
+            return f"Transcription failed: {e}"
+
+def _whisper_transcribe(audio_bytes: bytes) -> str:
+    """Runs local Whisper inference. Module-level so it can cross the
+    process-pool pickle boundary. Not wired up yet."""
+    raise NotImplementedError("Local Whisper inference is not implemented yet.")
+
+class WhisperTranscriber:
+    """Placeholder backend for on-device Whisper inference.
+
+    Local ASR is CPU-bound, so work is routed through a process pool —
+    threads cannot parallelize it under the GIL.
+    """
+
+    def __init__(self):
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count())
+
+    def transcribe(self, audio_bytes: bytes) -> str:
+        try:
+            return self._pool.submit(_whisper_transcribe, audio_bytes).result()
+        except Exception as e:
+            print(f"ERROR during local Whisper transcription: {e}")
+            return f"Transcription failed: {e}"
+
+# Backend selection (TRANSCRIBER_BACKEND=google|whisper) so local inference
+# can be A/B tested against Google without touching the webhook.
+if os.environ.get("TRANSCRIBER_BACKEND", "google") == "whisper":
+    _TRANSCRIBER: Transcriber = WhisperTranscriber()
+else:
+    _TRANSCRIBER = GoogleSTTTranscriber()
 
 def transcribe_audio_file(audio_bytes: bytes) -> str:
-    """Sends audio bytes to Google Cloud Speech-to-Text for transcription."""
-    
-    if not STT_CLIENT:
-        return "STT_CLIENT is unavailable."
-
-    # Custom Vocabulary using your specific terms
-    PHRASE_HINTS = [
-        "crumbs", "pellets", "day old chicks", "layer mash", 
-        "debt", "overpaid", "client", "price", "location", 
-        "matangi", "kitengela", "mihang'o", 
-        "one", "two", "three", "four", "five", "six", "seven", 
-        "500", "1000", "2000", "1200", "delivered"
-    ]
-    
-    audio = speech.RecognitionAudio(content=audio_bytes)
-    
-    config = speech.RecognitionConfig(
-        encoding=speech.RecognitionConfig.AudioEncoding.OGG_OPUS, 
-        sample_rate_hertz=16000,
-        language_code="en-US", 
-        # FIX: Changed 'speech_context' to the correct plural form 'speech_contexts'
-        speech_contexts=[speech.SpeechContext(phrases=PHRASE_HINTS)] 
-    )
-    
-    try:
-        response = STT_CLIENT.recognize(config=config, audio=audio)
-        if response.results:
-            return response.results[0].alternatives[0].transcript
-        return ""
-    except Exception as e:
-        print(f"ERROR during Google STT recognition: {e}")
-        return f"Transcription failed: {e}"
+    """Transcribes audio bytes via the configured backend, with caching."""
+
+    # blake2b is far cheaper than the transcription work it can save us.
+    cache_key = hashlib.blake2b(audio_bytes, digest_size=16).digest()
+    with _STT_CACHE_LOCK:
+        cached = _STT_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    transcript = _TRANSCRIBER.transcribe(audio_bytes)
+
+    # Only successful results are cached; failures should retry the backend.
+    if transcript != "STT_CLIENT is unavailable." and not transcript.startswith("Transcription failed"):
+        with _STT_CACHE_LOCK:
+            _STT_CACHE[cache_key] = transcript
+    return transcript
 
 
 # --- Google Sheets Logging ---
 
+# Rows go onto a queue drained by a single background worker, so the webhook
+# can return its TwiML immediately instead of blocking on the Sheets API.
+# The worker batches up to _LOG_BATCH_MAX rows (or whatever arrives within
+# _FLUSH_INTERVAL_SECONDS) into one append_rows call.
+_LOG_Q: queue.Queue = queue.Queue()
+_LOG_BATCH_MAX = 50
+_FLUSH_INTERVAL_SECONDS = 2.0
+
+# Rows are journaled to a small sqlite database (WAL mode) before the webhook
+# acknowledges, so a crash or redeploy between the "Database filled" reply
+# and the batched append does not lose a confirmed delivery. Rows are deleted
+# from the journal only after Sheets accepts them; anything left over is
+# re-queued at the next startup.
+_LOG_JOURNAL_PATH = os.environ.get("LOG_JOURNAL_PATH", "pending_rows.db")
+_JOURNAL_LOCK = threading.Lock()
+
+try:
+    _JOURNAL = sqlite3.connect(_LOG_JOURNAL_PATH, check_same_thread=False)
+    _JOURNAL.execute("PRAGMA journal_mode=WAL")
+    _JOURNAL.execute(
+        "CREATE TABLE IF NOT EXISTS pending_rows ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, row_json TEXT NOT NULL)"
+    )
+    _JOURNAL.commit()
+except Exception as e:
+    print(f"WARNING: Could not open the sheet-row journal; rows will only be buffered in memory: {e}")
+    _JOURNAL = None
+
+def _journal_insert(row_data: list) -> Optional[int]:
+    """Persists a row before it is acknowledged; returns its journal id."""
+    if _JOURNAL is None:
+        return None
+    with _JOURNAL_LOCK:
+        cursor = _JOURNAL.execute(
+            "INSERT INTO pending_rows (row_json) VALUES (?)", (json.dumps(row_data),)
+        )
+        _JOURNAL.commit()
+        return cursor.lastrowid
+
+def _journal_delete(row_ids: list) -> None:
+    """Removes rows from the journal once Sheets has accepted them."""
+    if _JOURNAL is None or not row_ids:
+        return
+    with _JOURNAL_LOCK:
+        _JOURNAL.executemany(
+            "DELETE FROM pending_rows WHERE id = ?", [(row_id,) for row_id in row_ids]
+        )
+        _JOURNAL.commit()
+
+def _requeue_journaled_rows() -> None:
+    """Re-queues rows a previous process journaled but never flushed."""
+    if _JOURNAL is None:
+        return
+    with _JOURNAL_LOCK:
+        leftover = _JOURNAL.execute(
+            "SELECT id, row_json FROM pending_rows ORDER BY id"
+        ).fetchall()
+    for row_id, row_json in leftover:
+        _LOG_Q.put((row_id, json.loads(row_json)))
+    if leftover:
+        print(f"Re-queued {len(leftover)} journaled sheet row(s) from a previous run.")
+
+def _drain_log_queue() -> None:
+    """Background worker: batches queued rows into bulk sheet appends."""
+    while True:
+        batch = [_LOG_Q.get()]
+        deadline = time.monotonic() + _FLUSH_INTERVAL_SECONDS
+        while len(batch) < _LOG_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_LOG_Q.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            SHEET.append_rows([row for _, row in batch], value_input_option='USER_ENTERED')
+        except Exception as e:
+            print(f"Error appending batched rows to Google Sheet: {e}")
+            # Re-queue the batch and back off so a Sheets outage doesn't spin.
+            for item in batch:
+                _LOG_Q.put(item)
+            time.sleep(_FLUSH_INTERVAL_SECONDS)
+            continue
+
+        try:
+            _journal_delete([row_id for row_id, _ in batch if row_id is not None])
+        except Exception as e:
+            print(f"WARNING: Could not clear flushed rows from the journal: {e}")
+
+if SHEET is not None:
+    _requeue_journaled_rows()
+    threading.Thread(target=_drain_log_queue, daemon=True).start()
+
 def log_to_google_sheet(data: Dict[str, Any]) -> bool:
-    """Appends the parsed delivery data to the Google Sheet."""
+    """Journals and queues the parsed delivery data for the background sheet writer."""
     if not SHEET:
         return False
-        
+
     try:
         # Log columns: Date, Client Phone Number, Client Index, Quantity, Feed, Price, Debt, Overpaid, Location, Notes, Reminders
         row_data = [
@@ -200,50 +564,106 @@ def log_to_google_sheet(data: Dict[str, Any]) -> bool:
             data['notes'],
             data['reminders']
         ]
-        
-        SHEET.append_row(row_data)
+
+        try:
+            row_id = _journal_insert(row_data)
+        except Exception as e:
+            # Degrade to memory-only buffering rather than refusing the log.
+            print(f"WARNING: Could not journal sheet row; queueing unjournaled: {e}")
+            row_id = None
+
+        _LOG_Q.put((row_id, row_data))
         return True
     except Exception as e:
-        print(f"Error appending data to Google Sheet: {e}")
+        print(f"Error queueing data for Google Sheet: {e}")
         return False
 
 
 # --- Twilio Webhook Logic ---
 
+def _render_twiml(text: str) -> str:
+    """Serializes a single-message TwiML reply."""
+    twiml = MessagingResponse()
+    twiml.message(text)
+    return str(twiml)
+
+# All fixed replies are serialized once at import; only the branches that
+# interpolate a transcription build TwiML at request time.
+_CANNED = {
+    'welcome': _render_twiml(
+        "Welcome! Please send a voice note with the delivery details, or reply '1' to confirm a pending transcription."
+    ),
+    'logged': _render_twiml(
+        "✅ Database filled! Delivery details have been successfully logged to the Google Sheet, and reminders calculated."
+    ),
+    'log_failed': _render_twiml(
+        "❌ ERROR: Failed to log data to the Google Sheet. Ensure your sheet has the tab name 'Sheet1' (or change the variable) and the service account has edit access."
+    ),
+    'no_pending': _render_twiml(
+        "I didn't find any pending transcription to confirm. Please send a voice note first."
+    ),
+    'download_failed': _render_twiml(
+        "❌ ERROR: Could not download the voice message. Check Twilio settings and ensure your credentials are correct."
+    ),
+    'config_error': _render_twiml(
+        "❌ CONFIGURATION ERROR: Twilio credentials not found. Check environment variables."
+    ),
+    'stt_unavailable': _render_twiml(
+        "Sorry, the transcription service is currently unavailable due to a configuration error. Please check server logs."
+    ),
+    'transcribe_failed': _render_twiml(
+        "Sorry, I could not transcribe the voice message. Ensure the audio is clear and you have properly set up the Google STT credentials."
+    ),
+    'fatal': _render_twiml(
+        "❌ FATAL ERROR: An unexpected server error occurred. The error has been logged for debugging. Please check your Render logs for the full Python traceback."
+    ),
+}
+
 @app.route("/whatsapp", methods=['GET', 'POST'])
 def whatsapp_reply():
     """Handles incoming WhatsApp messages for the two-step logging process."""
-    
+
     # NEW: Top-level error handler to catch *any* unhandled exception and log the traceback
     try:
-        resp = MessagingResponse()
-        from_number = request.values.get('From', '').replace('whatsapp:', '')
+        # Reject unsigned/forged webhooks before doing any other work.
+        if _REQUEST_VALIDATOR is not None:
+            signature = request.headers.get('X-Twilio-Signature', '')
+            if not _REQUEST_VALIDATOR.validate(request.url, request.form, signature):
+                print("WARNING: Rejected webhook with invalid Twilio signature.")
+                return Response("Invalid Twilio signature.", status=403)
+
         incoming_text = request.values.get('Body', '').strip()
         num_media = int(request.values.get('NumMedia', 0))
 
+        # Fast path: ordinary text that isn't a confirmation and carries no
+        # media needs none of the sender/media fields — answer immediately.
+        if incoming_text != '1' and num_media == 0:
+            return Response(_CANNED['welcome'], mimetype='application/xml')
+
+        from_number = request.values.get('From', '').replace('whatsapp:', '')
+
         # --- PHASE 2: Confirmation / Logging ---
         if incoming_text == '1':
-            if from_number in PENDING_TRANSCRIPTIONS:
-                transcription = PENDING_TRANSCRIPTIONS.pop(from_number)
-                delivery_data = parse_delivery_transcription(transcription)
-
-                if delivery_data:
-                    # Calculate the date and reminders based on the current time
-                    delivery_date = datetime.now()
-                    delivery_data['date'] = delivery_date.strftime('%Y-%m-%d')
-                    delivery_data['phone_number'] = from_number
-                    delivery_data['reminders'] = calculate_reminders(delivery_date)
-                    
-                    if log_to_google_sheet(delivery_data):
-                        resp.message("✅ Database filled! Delivery details have been successfully logged to the Google Sheet, and reminders calculated.")
-                    else:
-                        resp.message("❌ ERROR: Failed to log data to the Google Sheet. Ensure your sheet has the tab name 'Sheet1' (or change the variable) and the service account has edit access.")
-                else:
-                    resp.message(f"❌ ERROR: The transcription could not be parsed into fields. Please ensure the voice note follows the expected format. Transcription received: {transcription}")
-            else:
-                resp.message("I didn't find any pending transcription to confirm. Please send a voice note first.")
-            
-            return Response(str(resp), mimetype='application/xml')
+            transcription = _pop_pending_transcription(from_number)
+            if transcription is None:
+                return Response(_CANNED['no_pending'], mimetype='application/xml')
+
+            delivery_data = parse_delivery_transcription(transcription)
+            if not delivery_data:
+                return Response(
+                    _render_twiml(f"❌ ERROR: The transcription could not be parsed into fields. Please ensure the voice note follows the expected format. Transcription received: {transcription}"),
+                    mimetype='application/xml'
+                )
+
+            # Calculate the date and reminders based on the current time
+            delivery_date = datetime.now()
+            delivery_data['date'] = delivery_date.strftime('%Y-%m-%d')
+            delivery_data['phone_number'] = from_number
+            delivery_data['reminders'] = calculate_reminders(delivery_date)
+
+            if log_to_google_sheet(delivery_data):
+                return Response(_CANNED['logged'], mimetype='application/xml')
+            return Response(_CANNED['log_failed'], mimetype='application/xml')
 
         # --- PHASE 1: Voice Note Transcription ---
         elif num_media > 0 and request.values.get('MediaContentType0', '').startswith('audio'):
@@ -255,62 +675,59 @@ def whatsapp_reply():
                 if not TWILIO_ACCOUNT_SID or not TWILIO_AUTH_TOKEN:
                     raise ValueError("Twilio credentials are not loaded from environment variables.")
 
-                audio_response = requests.get(
-                    media_url, 
-                    auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN), 
-                    timeout=10
+                # The STT channel is warmed once at startup, so the download
+                # is the only network work left on this path.
+                audio_response = _HTTP.get(
+                    media_url,
+                    auth=(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+                    timeout=10,
+                    stream=True
                 )
-                audio_response.raise_for_status() 
-                audio_bytes = audio_response.content
+                audio_response.raise_for_status()
+                # Read the raw stream in one go: a single allocation instead
+                # of chunk objects plus a join copy.
+                with audio_response:
+                    audio_bytes = audio_response.raw.read(decode_content=True)
             except requests.exceptions.RequestException as e:
                 # Log the specific request error for detailed debugging on Render
-                print(f"REQUESTS ERROR downloading media: {e}") 
-                resp.message("❌ ERROR: Could not download the voice message. Check Twilio settings and ensure your credentials are correct.")
-                return Response(str(resp), mimetype='application/xml')
+                print(f"REQUESTS ERROR downloading media: {e}")
+                return Response(_CANNED['download_failed'], mimetype='application/xml')
             except ValueError as e:
                 print(f"CONFIGURATION ERROR: {e}")
-                resp.message("❌ CONFIGURATION ERROR: Twilio credentials not found. Check environment variables.")
-                return Response(str(resp), mimetype='application/xml')
+                return Response(_CANNED['config_error'], mimetype='application/xml')
 
-            if STT_CLIENT:
-                transcribed_text = transcribe_audio_file(audio_bytes)
-            else:
+            if not STT_CLIENT:
                 # Handle the case where the STT client failed to initialize globally
-                transcribed_text = ""
-                resp.message("Sorry, the transcription service is currently unavailable due to a configuration error. Please check server logs.")
                 print("STT_CLIENT is None. Check setup_google_stt_client logs for details.")
-                return Response(str(resp), mimetype='application/xml') # Early exit on critical error
-            
+                return Response(_CANNED['stt_unavailable'], mimetype='application/xml') # Early exit on critical error
+
+            transcribed_text = transcribe_audio_file(audio_bytes)
+
             if transcribed_text and not transcribed_text.startswith("Transcription failed") and transcribed_text != "No transcription results found.":
-                PENDING_TRANSCRIPTIONS[from_number] = transcribed_text
-                
+                _store_pending_transcription(from_number, transcribed_text)
+
                 response_msg = (
                     f"I heard: **{transcribed_text}**\n\n"
                     "To confirm this transcription and fill the database, **REPLY WITH 1**."
                 )
-                resp.message(response_msg)
-            else:
-                # If STT failed to transcribe (e.g., error from Google API)
-                print(f"Transcription failed or found no results. Output: {transcribed_text}")
-                resp.message("Sorry, I could not transcribe the voice message. Ensure the audio is clear and you have properly set up the Google STT credentials.")
-                
-            return Response(str(resp), mimetype='application/xml')
-
-        # --- Default Text Handler ---
+                return Response(_render_twiml(response_msg), mimetype='application/xml')
+
+            # If STT failed to transcribe (e.g., error from Google API)
+            print(f"Transcription failed or found no results. Output: {transcribed_text}")
+            return Response(_CANNED['transcribe_failed'], mimetype='application/xml')
+
+        # --- Default Handler (e.g. non-audio media) ---
         else:
-            resp.message("Welcome! Please send a voice note with the delivery details, or reply '1' to confirm a pending transcription.")
-            return Response(str(resp), mimetype='application/xml')
-            
+            return Response(_CANNED['welcome'], mimetype='application/xml')
+
     except Exception as e:
         # This catches any remaining unhandled error in the function
         print(f"CRITICAL UNHANDLED ERROR processing WhatsApp message: {e}")
         # Print the full traceback to the Render logs
         print(traceback.format_exc())
-        
+
         # Return a controlled error message to Twilio
-        resp_error = MessagingResponse()
-        resp_error.message("❌ FATAL ERROR: An unexpected server error occurred. The error has been logged for debugging. Please check your Render logs for the full Python traceback.")
-        return Response(str(resp_error), mimetype='application/xml', status=500)
+        return Response(_CANNED['fatal'], mimetype='application/xml', status=500)
 
 if __name__ == '__main__':
 